@@ -16,7 +16,12 @@ setup(
     packages=find_packages(where="src"),
     install_requires=[
         "pandas>=2.3.0",
+        "numpy>=1.22",
+        "urllib3>=2",
     ],
+    extras_require={
+        "fast": ["pyarrow", "isal"],
+    },
     entry_points={
         "console_scripts": [
             "sylph2krona=sylph2krona.sylph2krona:main",
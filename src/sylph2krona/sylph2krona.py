@@ -4,88 +4,137 @@
 # @license    MIT
 # @author     Jonas Ohlsson <jonas.ohlsson at slu.se>
 # @depends    pandas>=2.3,<3
+# @depends    numpy>=1.22
+# @depends    urllib3>=2
 """
 Convert Sylph profiles to Krona-compatible format using GTDB taxonomy.
 """
 
 import re
+import io
+import csv
 import sys
 import os
 import hashlib
 import argparse
+import threading
+import urllib3
+import numpy as np
 import pandas as pd
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from . import __version__
 
-
-def read_gtdb_tax(paths):
-    # read one or more gtdb taxonomy tsvs (two cols: id \t taxonomy)
-    # keys look like RS_GCF_..., GB_GCA_...; we store both the raw key and a version stripped of RS_/GB_
-    frames = []
-    for p in paths:
-        if p is None:
-            continue
-        # Handle gzipped files
-        if p.endswith(".gz"):
-            # pandas can read directly from gzipped files
-            df = pd.read_csv(
-                p,
+# use pyarrow's multi-threaded csv parser when available
+try:
+    import pyarrow  # noqa: F401
+
+    _CSV_ENGINE = "pyarrow"
+except ImportError:
+    _CSV_ENGINE = "c"
+
+# use isa-l accelerated gzip decompression when available
+try:
+    from isal import igzip as _gz
+except ImportError:
+    import gzip as _gz
+
+# shared connection pool so repeated requests to the gtdb mirrors reuse keep-alive connections
+_HTTP = urllib3.PoolManager(maxsize=4, retries=urllib3.Retry(3))
+
+# serializes progress messages from concurrent downloads
+_PRINT_LOCK = threading.Lock()
+
+# gca/gcf accession with version, pulled from genome paths like .../GCA_012345678.1_genomic.fna.gz
+_ACC_RE = re.compile(r"((?:GCA|GCF)_\d+\.\d+)")
+# gtdb rank prefix at the start of each taxonomy level, e.g. 'd__' or ';p__'
+_RANK_RE = re.compile(r"(^|;)[dpcofgst]__")
+# gtdb database prefix on taxonomy ids
+_PREFIX_RE = re.compile(r"^(RS_|GB_)")
+# trailing accession version
+_NOVERS_RE = re.compile(r"\.\d+$")
+# gtdb release suffix in MD5SUM.txt filenames, e.g. _r226
+_R_VERSION_RE = re.compile(r"_r\d+")
+# fallback_from_contig helpers
+_CONTIG_PREFIX_RE = re.compile(r"^[^:]+:\s*")
+_WS_RE = re.compile(r"\s+")
+_TOKEN_RE = re.compile(r"[^A-Za-z0-9_-]")
+_FALLBACK_STOPWORDS = frozenset({"bin", "isolate", "strain", "mag", "tpa_asm"})
+# characters not allowed in output filenames
+_SAFE_RE = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def _read_one_tax(p):
+    # read a single gtdb taxonomy tsv (two cols: id \t taxonomy)
+    # Handle gzipped files
+    if p.endswith(".gz"):
+        with _gz.open(p, "rb") as fh:
+            return pd.read_csv(
+                fh,
                 sep="\t",
                 header=None,
                 names=["gtdb_id", "gtdb_taxonomy"],
-                compression="gzip",
-            )
-        else:
-            df = pd.read_csv(
-                p, sep="\t", header=None, names=["gtdb_id", "gtdb_taxonomy"]
+                engine=_CSV_ENGINE,
             )
-        frames.append(df)
-    if not frames:
+    return pd.read_csv(
+        p,
+        sep="\t",
+        header=None,
+        names=["gtdb_id", "gtdb_taxonomy"],
+        engine=_CSV_ENGINE,
+    )
+
+
+def read_gtdb_tax(paths, needed=None):
+    # read one or more gtdb taxonomy tsvs (two cols: id \t taxonomy)
+    # keys look like RS_GCF_..., GB_GCA_...; we store both the raw key and a version stripped of RS_/GB_
+    # if needed is given, only ids matching one of those accessions are kept in the map
+    paths = [p for p in paths if p is not None]
+    if not paths:
         return {}
+    # the files are independent, so parse them concurrently
+    with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+        frames = list(ex.map(_read_one_tax, paths))
     gtdb = pd.concat(frames, ignore_index=True).drop_duplicates("gtdb_id")
     # make a dict with multiple access patterns
+    ids = gtdb["gtdb_id"]
+    tax = gtdb["gtdb_taxonomy"]
+    if needed is not None:
+        # a profile usually hits a tiny fraction of gtdb, so drop the rest before any
+        # regex work; slicing off the 3-char RS_/GB_ prefix is enough to compare
+        keep = ids.str[3:].isin(needed) | ids.isin(needed)
+        ids, tax = ids[keep], tax[keep]
+    # strip RS_/GB_ prefix
+    bare = ids.str.replace(_PREFIX_RE, "", regex=True)
+    # also keep a key without version, just in case (e.g., GCA_012345678)
+    novers = bare.str.replace(_NOVERS_RE, "", regex=True)
+    # many genomes share a taxonomy string; point all dict values at one interned copy
+    canonical = {t: sys.intern(t) for t in tax.dropna().unique()}
+    tax = tax.map(canonical)
     taxmap = {}
-    for gid, tax in zip(gtdb["gtdb_id"], gtdb["gtdb_taxonomy"]):
-        taxmap[gid] = tax
-        # strip RS_/GB_ prefix
-        bare = re.sub(r"^(RS_|GB_)", "", gid)
-        taxmap[bare] = tax
-        # also keep a key without version, just in case (e.g., GCA_012345678)
-        novers = re.sub(r"\.\d+$", "", bare)
-        taxmap[novers] = tax
+    taxmap.update(zip(ids, tax))
+    taxmap.update(zip(bare, tax))
+    taxmap.update(zip(novers, tax))
     return taxmap
 
 
-def extract_accession(genome_file):
-    # pull gca/gcf accession with version from a path like .../GCA_012345678.1_genomic.fna.gz
-    m = re.search(r"(GCA|GCF)_\d+\.\d+", genome_file)
-    return m.group(0) if m else None
-
-
 def gtdb_to_krona_path(tax):
-    # convert 'd__Bacteria;p__Firmicutes;...' to a krona path like 'root;Bacteria;Firmicutes;...'
-    if pd.isna(tax) or tax == "":
-        return None
-    parts = tax.split(";")
-    parts = [re.sub(r"^(d|p|c|o|f|g|s|t)__", "", p) for p in parts]
-    return "root;" + ";".join(parts)
+    # convert a series of 'd__Bacteria;p__Firmicutes;...' to krona paths like 'root;Bacteria;Firmicutes;...'
+    # missing or empty taxonomies become NaN
+    tax = tax.astype(object).where(tax != "")
+    return "root;" + tax.str.replace(_RANK_RE, r"\1", regex=True)
 
 
 def fallback_from_contig(contig_name):
     # very light heuristic fallback if accession not found in gtdb
     # strip leading accession and any prefix up to colon, cut at first comma
-    s = re.sub(r"^[^:]+:\s*", "", contig_name)
+    s = _CONTIG_PREFIX_RE.sub("", contig_name)
     s = s.split(",", 1)[0].strip()
     if not s:
         return "root;unclassified"
-    toks = re.split(r"\s+", s)
-    toks = [
-        t
-        for t in toks
-        if t.lower() not in {"bin", "isolate", "strain", "mag", "tpa_asm"}
-    ]
-    toks = [re.sub(r"[^A-Za-z0-9_-]", "_", t) for t in toks if t]
+    toks = _WS_RE.split(s)
+    toks = [t for t in toks if t.lower() not in _FALLBACK_STOPWORDS]
+    toks = [_TOKEN_RE.sub("_", t) for t in toks if t]
     if not toks:
         toks = ["unclassified"]
     return "root;" + ";".join(toks)
@@ -93,7 +142,46 @@ def fallback_from_contig(contig_name):
 
 def safe_fname(x):
     # make filesystem-friendly filename
-    return re.sub(r"[^A-Za-z0-9._-]", "_", x)
+    return _SAFE_RE.sub("_", x)
+
+
+def _http_get(url, **kwargs):
+    # GET through the shared pool, raising on http errors like urlopen does
+    response = _HTTP.request("GET", url, **kwargs)
+    if response.status >= 400:
+        response.release_conn()
+        raise urllib3.exceptions.HTTPError(f"HTTP Error {response.status}")
+    return response
+
+
+def _write_one(out_path, abundances, paths):
+    # write a single sample's krona text file
+    # shorter paths are padded with empty cells up to the deepest path in this sample
+    width = max((len(p) for p in paths), default=0)
+    with open(out_path, "w", newline="") as fh:
+        w = csv.writer(fh, delimiter="\t", lineterminator="\n")
+        w.writerows(
+            [a, *p, *[""] * (width - len(p))] for a, p in zip(abundances, paths)
+        )
+
+
+def _log(msg):
+    # print a whole line at once so concurrent downloads don't interleave
+    with _PRINT_LOCK:
+        print(msg, flush=True)
+
+
+class _DownloadCancelled(Exception):
+    # raised in a download thread after another download has already failed
+    pass
+
+
+def _discard(path):
+    # remove a partial or unverified download so the next run doesn't pick it up
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
 def get_gtdb_version():
@@ -106,18 +194,17 @@ def get_gtdb_version():
 
     for url in urls:
         try:
-            with urllib.request.urlopen(url) as response:
-                content = response.read().decode("utf-8")
-                # Extract just the first line
-                version = content.split("\n")[0].strip()
-                return version
+            content = _http_get(url).data.decode("utf-8")
+            # Extract just the first line
+            version = content.split("\n")[0].strip()
+            return version
         except Exception as e:
             print(f"Warning: Failed to fetch GTDB version from {url}: {str(e)}")
 
     return "unknown"
 
 
-def download_taxonomy_file(file_name):
+def download_taxonomy_file(file_name, checksums=None, cancel=None):
     """Download GTDB taxonomy file if it doesn't exist locally"""
     if os.path.exists(file_name):
         return file_name
@@ -129,8 +216,9 @@ def download_taxonomy_file(file_name):
     # download gzipped taxonomy
     download_name = f"{file_name}.gz" if not file_name.endswith(".gz") else file_name
 
-    # get md5 checksums for verification
-    checksums = get_md5_checksums()
+    # get md5 checksums for verification, unless the caller already fetched them
+    if checksums is None:
+        checksums = get_md5_checksums()
     base_filename = os.path.basename(download_name)
     expected_md5 = checksums.get(base_filename)
 
@@ -140,28 +228,47 @@ def download_taxonomy_file(file_name):
         f"https://data.gtdb.ecogenomic.org/releases/latest/{os.path.basename(download_name)}",
     ]
 
-    print(f"Downloading {os.path.basename(download_name)}... ", end="")
+    _log(f"Downloading {os.path.basename(download_name)}...")
     for url in urls:
         try:
-            urllib.request.urlretrieve(url, download_name)
-            print(f"Saved to {download_name}")
+            # stream the body straight to disk, leaving the gzip payload untouched,
+            # and hash it on the way so the file never has to be read back
+            md5 = hashlib.md5()
+            response = _http_get(url, preload_content=False, decode_content=False)
+            try:
+                with open(download_name, "wb") as fh:
+                    for chunk in response.stream(1 << 20, decode_content=False):
+                        # another download failed, so this one is no longer needed
+                        if cancel is not None and cancel.is_set():
+                            break
+                        md5.update(chunk)
+                        fh.write(chunk)
+            finally:
+                response.release_conn()
+            if cancel is not None and cancel.is_set():
+                _discard(download_name)
+                raise _DownloadCancelled(download_name)
+            _log(f"Saved to {download_name}")
 
             # verify md5 checksum if available
             if expected_md5:
-                with open(download_name, "rb") as f:
-                    file_md5 = hashlib.md5(f.read()).hexdigest()
+                file_md5 = md5.hexdigest()
 
                 if not file_md5 == expected_md5:
-                    print(
+                    _log(
                         f"ERROR: MD5 checksum mismatch! Expected {expected_md5}, got {file_md5}"
                     )
+                    _discard(download_name)
                     sys.exit(1)
             else:
-                print("No MD5 checksum available for verification")
+                _log("No MD5 checksum available for verification")
 
             return download_name
+        except _DownloadCancelled:
+            raise
         except Exception as e:
-            print(f"Failed to download from {url}: {str(e)}")
+            _discard(download_name)
+            _log(f"Failed to download from {url}: {str(e)}")
 
     sys.exit(f"ERROR: Could not download taxonomy file {file_name}. Exiting.")
     return None
@@ -177,21 +284,20 @@ def get_md5_checksums():
     checksums = {}
     for url in urls:
         try:
-            with urllib.request.urlopen(url) as response:
-                content = response.read().decode("utf-8")
-                # Parse each line - format is "md5hash  ./filename"
-                for line in content.splitlines():
-                    if line.strip():
-                        parts = line.split()
-                        if len(parts) >= 2:
-                            md5_hash = parts[0].strip()
-                            filename = os.path.basename(parts[1].strip())
-                            # Remove version suffix like _r123 to match generic filenames
-                            generic_name = re.sub(r"_r\d+", "", filename)
-                            checksums[generic_name] = md5_hash
-                            # Also keep the original name for direct matching
-                            checksums[filename] = md5_hash
-                return checksums
+            content = _http_get(url).data.decode("utf-8")
+            # Parse each line - format is "md5hash  ./filename"
+            for line in content.splitlines():
+                if line.strip():
+                    parts = line.split()
+                    if len(parts) >= 2:
+                        md5_hash = parts[0].strip()
+                        filename = os.path.basename(parts[1].strip())
+                        # Remove version suffix like _r123 to match generic filenames
+                        generic_name = _R_VERSION_RE.sub("", filename)
+                        checksums[generic_name] = md5_hash
+                        # Also keep the original name for direct matching
+                        checksums[filename] = md5_hash
+            return checksums
         except Exception as e:
             print(f"Warning: Failed to fetch MD5 checksums from {url}: {str(e)}")
 
@@ -237,31 +343,6 @@ def main():
         print(f"sylph2krona v{__version__}")
         sys.exit(0)
 
-    # Get GTDB version before downloading files
-    gtdb_version = get_gtdb_version()
-
-    # download taxonomy files if they don't exist
-    bac_file = download_taxonomy_file(args.bac)
-    ar_file = download_taxonomy_file(args.ar)
-
-    def check_file_exists(file_path):
-        return os.path.exists(file_path) or os.path.exists(f"{file_path}.gz")
-
-    if not (check_file_exists(args.bac) and check_file_exists(args.ar)):
-        print(
-            f"\nWARNING: GTDB taxonomy files are downloaded for version {gtdb_version}. "
-            f"Make sure that this version matches your sylph database!\n"
-        )
-
-    # load gtdb taxonomy maps
-    taxmap = read_gtdb_tax([bac_file, ar_file])
-
-    # read sylph profile - handle stdin if input is "-"
-    if args.input == "-":
-        sylph = pd.read_csv(sys.stdin, sep="\t")
-    else:
-        sylph = pd.read_csv(args.input, sep="\t")
-
     # Map short abundance options to full column names
     abundance_map = {
         "tax": "Taxonomic_abundance",
@@ -269,53 +350,140 @@ def main():
     }
     abundance_col = abundance_map[args.abundance]
 
+    # read sylph profile - handle stdin if input is "-"
+    # stdin is buffered so the header can be checked before the full parse
+    if args.input == "-":
+        source = io.BytesIO(sys.stdin.buffer.read())
+    else:
+        source = args.input
+
     # basic column checks
     required_cols = {"Sample_file", "Genome_file", "Contig_name", abundance_col}
-    missing = required_cols - set(sylph.columns)
+    header = pd.read_csv(source, sep="\t", nrows=0).columns
+    missing = required_cols - set(header)
     if missing:
         sys.exit(
             f"missing required columns in sylph file: {', '.join(sorted(missing))}"
         )
+    if isinstance(source, io.BytesIO):
+        source.seek(0)
+
+    # only parse the columns we use; sylph profiles carry many more
+    sylph = pd.read_csv(
+        source, sep="\t", usecols=sorted(required_cols), engine=_CSV_ENGINE
+    )
+
+    # extract accession, so only the genomes present in the profile are loaded from gtdb
+    sylph["accession"] = sylph["Genome_file"].str.extract(_ACC_RE, expand=False)
+
+    def check_file_exists(file_path):
+        return os.path.exists(file_path) or os.path.exists(f"{file_path}.gz")
+
+    # Get GTDB version before downloading files; not needed when both are already local
+    needs_download = not (check_file_exists(args.bac) and check_file_exists(args.ar))
+    checksums = {}
+    if needs_download:
+        gtdb_version = get_gtdb_version()
+        # fetch checksums once here rather than once per download thread
+        checksums = get_md5_checksums()
+
+    cancel = threading.Event()
+    failures = []
+
+    def fetch_taxonomy(file_name):
+        try:
+            return download_taxonomy_file(file_name, checksums, cancel)
+        except _DownloadCancelled:
+            raise
+        except BaseException as e:
+            # stop the other transfer instead of waiting for it to finish
+            failures.append(e)
+            cancel.set()
+            raise
+
+    # download taxonomy files if they don't exist, overlapping the transfers
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        try:
+            futures = [ex.submit(fetch_taxonomy, f) for f in (args.bac, args.ar)]
+            for f in futures:
+                f.exception()
+        except BaseException:
+            # e.g. ctrl-c in the main thread; don't wait for the transfers to finish
+            cancel.set()
+            raise
+    # report the download that actually failed, not the one cancelled because of it
+    if failures:
+        raise failures[0]
+    bac_file, ar_file = (f.result() for f in futures)
+
+    if needs_download:
+        print(
+            f"\nWARNING: GTDB taxonomy files are downloaded for version {gtdb_version}. "
+            f"Make sure that this version matches your sylph database!\n"
+        )
 
-    # extract accession and map to taxonomy
-    sylph["accession"] = sylph["Genome_file"].apply(extract_accession)
+    # load gtdb taxonomy maps
+    taxmap = read_gtdb_tax(
+        [bac_file, ar_file], needed=set(sylph["accession"].dropna())
+    )
+
+    # map accessions to taxonomy
     sylph["gtdb_taxonomy"] = sylph["accession"].map(taxmap)
 
     # build krona path with gtdb, falling back to contig-based heuristic
-    sylph["krona_path"] = sylph.apply(
-        lambda r: str(
-            gtdb_to_krona_path(r["gtdb_taxonomy"])
-            if pd.notna(r["gtdb_taxonomy"]) and r["gtdb_taxonomy"] != ""
-            else fallback_from_contig(r["Contig_name"])
-        ),
-        axis=1,
-    )
+    # only for the rows that have no taxonomy
+    has_tax = sylph["gtdb_taxonomy"].notna() & (sylph["gtdb_taxonomy"] != "")
+    gtdb_paths = gtdb_to_krona_path(sylph["gtdb_taxonomy"])
+    fallback_paths = sylph.loc[~has_tax, "Contig_name"].map(fallback_from_contig)
+    sylph["krona_path"] = gtdb_paths.where(has_tax, fallback_paths)
 
     # choose abundance
     sylph["abundance"] = sylph[abundance_col].astype(float)
 
     # aggregate identical paths per sample
-    grouped = sylph.groupby(["Sample_file", "krona_path"], as_index=False)[
-        "abundance"
-    ].sum()
+    # both keys repeat heavily, so group on categorical codes rather than hashing strings
+    sylph["Sample_file"] = sylph["Sample_file"].astype("category")
+    sylph["krona_path"] = sylph["krona_path"].astype("category")
+    grouped = sylph.groupby(
+        ["Sample_file", "krona_path"], as_index=False, observed=True
+    )["abundance"].sum()
 
     # write one krona file per cleaned sample name
     outdir = Path(args.outdir)
     outdir.mkdir(parents=True, exist_ok=True)
 
+    # krona expects: number \t level1 \t level2 ... but also accepts 'number \t semicolon path'
+    # we will split the semicolon path into columns to be maximally compliant
+    # path like 'root;a;b;c' -> columns: number, root, a, b, c
+    # split all samples in one pass; each sample is then just a slice
+    # plain lists so rows can go straight to csv.writer without building a frame
+    paths = grouped["krona_path"].str.split(";").tolist()
+    abundances = grouped["abundance"].tolist()
+
+    # grouped is sorted by sample code, so each sample's rows are a contiguous block
+    # starting wherever the code changes
+    codes = grouped["Sample_file"].cat.codes.to_numpy()
+    starts = np.flatnonzero(np.diff(codes, prepend=-1))
+    ends = np.append(starts[1:], len(grouped))
+    samples = grouped["Sample_file"].to_numpy()[starts]
+
+    # resolve every output path up front; samples whose names clean up to the same
+    # filename overwrite each other in sample order, so only the last one is written
     written = []
-    for sample, g in grouped.groupby("Sample_file"):
+    blocks = {}
+    for sample, start, end in zip(samples, starts, ends):
         out_path = outdir / f"{safe_fname(sample)}_krona.txt"
-        g_out = g[["abundance", "krona_path"]].copy()
-        # krona expects: number \t level1 \t level2 ... but also accepts 'number \t semicolon path'
-        # we will split the semicolon path into columns to be maximally compliant
-        # path like 'root;a;b;c' -> columns: number, root, a, b, c
-        split_cols = g_out["krona_path"].str.split(";", expand=True)
-        to_write = pd.concat([g_out[["abundance"]], split_cols], axis=1)
-        to_write.to_csv(out_path, sep="\t", header=False, index=False)
-        # g_out.to_csv(out_path, sep="\t", header=False, index=False)
+        blocks[out_path] = (start, end)
         written.append((out_path, sample))
 
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(blocks)))) as ex:
+        futures = [
+            ex.submit(_write_one, out_path, abundances[start:end], paths[start:end])
+            for out_path, (start, end) in blocks.items()
+        ]
+        for f in futures:
+            f.result()
+
     # print a handy ktImportText command suggestion to stdout
     args_joined = " ".join(f"{p},{n}" for p, n in written)
     print("# run this to build a multi-dataset krona chart")